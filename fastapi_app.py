@@ -1,17 +1,22 @@
 import os
 import sys
 import io
-import tempfile
+import asyncio
+import hashlib
+from urllib.parse import urlsplit
 from typing import Tuple
 
 from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, ORJSONResponse
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.responses import Response
 
 from PIL import Image
-import requests
+import cachetools
+import cv2
+import httpx
+import numpy as np
 
 # Ensure project root is on path to import table_cropper
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -21,7 +26,62 @@ if CURRENT_DIR not in sys.path:
 from table_cropper import AdvancedTableCropper  # type: ignore
 
 
-app = FastAPI(title="DKN Table Cropper API (FastAPI)", version="1.0.0")
+app = FastAPI(
+    title="DKN Table Cropper API (FastAPI)",
+    version="1.0.0",
+    default_response_class=ORJSONResponse,
+)
+
+TMPFILES_UPLOAD_URL = "https://tmpfiles.org/api/v1/upload"
+PNG_COMPRESS_LEVEL = 1
+JPEG_QUALITY = 88
+
+# Crop-preview output formats: output_format form value -> (file extension, content type)
+_PREVIEW_FORMATS = {
+    "png": ("png", "image/png"),
+    "jpeg": ("jpg", "image/jpeg"),
+}
+
+# Accepted image MIME subtypes, including the legacy aliases some clients still send
+_ALLOWED_IMAGE_SUBTYPES = frozenset({
+    "jpeg", "jpg", "pjpeg",
+    "png", "x-png", "apng",
+    "bmp", "x-bmp", "x-ms-bmp", "vnd.ms-bmp", "x-windows-bmp",
+    "tiff", "x-tiff",
+})
+
+# Bound concurrent cropper runs so a burst of uploads can't pile up unbounded worker threads
+CROPPER_MAX_WORKERS = os.cpu_count() or 1
+_cropper_semaphore = asyncio.Semaphore(CROPPER_MAX_WORKERS)
+
+# Max /api/crop-preview-batch images in flight at once, to stay within CPU and tmpfiles.org
+# rate limits
+BATCH_MAX_CONCURRENCY = 5
+_batch_semaphore = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+
+# The only cropper output the API uses; the full-size original and intermediates are never
+# converted, so they are freed as soon as the cropper returns
+PREVIEW_IMAGE_KEYS = ("perspective_corrected",)
+
+# Shared across requests; the cropper holds only fixed table geometry, so concurrent use is safe
+CROPPER = AdvancedTableCropper()
+
+# Responses for identical inputs (e.g. frontend retries), keyed by content hash. Entries expire
+# a little before tmpfiles.org's 60 minute retention so a cached URL is never already gone.
+RESULT_CACHE_TTL_SECONDS = 50 * 60
+_result_cache: cachetools.TTLCache = cachetools.TTLCache(maxsize=256, ttl=RESULT_CACHE_TTL_SECONDS)
+
+# Recently downloaded image_url bodies. tmpfiles.org sends no cache headers, so repeat hits on
+# the same URL moments later are served from here instead of being fetched again. Only tmpfiles
+# URLs and responses without cache headers are stored; anything else is always re-fetched.
+DOWNLOAD_CACHE_TTL_SECONDS = 5 * 60
+# Bounded by total bytes rather than entry count; bodies above the per-item cap are not cached
+DOWNLOAD_CACHE_MAX_BYTES = 64 * 1024 * 1024
+DOWNLOAD_CACHE_MAX_ITEM_BYTES = 16 * 1024 * 1024
+_download_cache: cachetools.TTLCache = cachetools.TTLCache(
+    maxsize=DOWNLOAD_CACHE_MAX_BYTES, ttl=DOWNLOAD_CACHE_TTL_SECONDS, getsizeof=len
+)
+_CACHE_HEADERS = ("cache-control", "etag", "expires", "last-modified")
 
 # CORS for local dev and deployments (adjust origins as needed)
 app.add_middleware(
@@ -33,48 +93,154 @@ app.add_middleware(
 )
 
 
+@app.on_event("startup")
+async def _startup() -> None:
+    # Shared client so tmpfiles uploads and URL downloads reuse pooled keep-alive connections;
+    # HTTP/2 lets concurrent uploads multiplex over a single connection
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+        timeout=30.0,
+        follow_redirects=True,
+    )
+
+
+@app.on_event("shutdown")
+async def _shutdown() -> None:
+    await app.state.http.aclose()
+
+
 @app.get("/api/health")
 async def health_check():
     return {"status": "healthy", "service": "DKN Table Cropper API (FastAPI)", "version": "1.0.0"}
 
 
 def _validate_image_content_type(upload: UploadFile) -> None:
-    content_type = (upload.content_type or "").lower()
-    if not any(content_type.endswith(ext) for ext in ["jpeg", "jpg", "png", "bmp", "tiff"]):
+    subtype = (upload.content_type or "").lower().rsplit("/", 1)[-1]
+    if subtype not in _ALLOWED_IMAGE_SUBTYPES:
         raise HTTPException(status_code=400, detail="Unsupported file type. Upload PNG/JPG/JPEG/BMP/TIFF.")
 
 
-def _pil_to_png_bytes(pil_img: Image.Image) -> bytes:
-    buf = io.BytesIO()
-    save_img = pil_img
-    if pil_img.mode not in ("RGB", "RGBA"):
-        save_img = pil_img.convert("RGB")
-    save_img.save(buf, format="PNG")
-    return buf.getvalue()
+def _bgr_array_to_png_bytes(bgr: np.ndarray) -> bytes:
+    # Fast zlib level: outputs are short-lived tmpfiles uploads, so encode time beats size
+    ok, buf = cv2.imencode(".png", bgr, [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESS_LEVEL])
+    if not ok:
+        raise ValueError("PNG encoding failed")
+    return buf.tobytes()
+
+
+def _bgr_array_to_jpeg_bytes(bgr: np.ndarray) -> bytes:
+    # opencv-python bundles libjpeg-turbo, so this is far faster than PNG and roughly half the size
+    ok, buf = cv2.imencode(".jpg", bgr, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    if not ok:
+        raise ValueError("JPEG encoding failed")
+    return buf.tobytes()
+
+
+def _validate_output_format(output_format: str) -> str:
+    fmt = output_format.lower()
+    if fmt == "jpg":
+        fmt = "jpeg"
+    if fmt not in _PREVIEW_FORMATS:
+        raise HTTPException(status_code=400, detail="Unsupported output_format. Use 'png' or 'jpeg'.")
+    return fmt
+
+
+def _content_hash(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _is_download_cacheable(url: str, resp: httpx.Response) -> bool:
+    host = (urlsplit(url).hostname or "").lower()
+    if host == "tmpfiles.org" or host.endswith(".tmpfiles.org"):
+        return True
+    return not any(header in resp.headers for header in _CACHE_HEADERS)
+
+
+async def _download_image(url: str) -> bytes:
+    cached = _download_cache.get(url)
+    if cached is not None:
+        return cached
+    resp = await app.state.http.get(url)
+    if resp.status_code != 200:
+        raise HTTPException(status_code=400, detail=f"Failed to download image: HTTP {resp.status_code}")
+    if len(resp.content) <= DOWNLOAD_CACHE_MAX_ITEM_BYTES and _is_download_cacheable(url, resp):
+        _download_cache[url] = resp.content
+    return resp.content
+
 
+def _decode_and_crop(file_bytes: bytes, base_name: str):
+    # Decode in memory instead of round-tripping through a temporary file
+    cv_image = cv2.imdecode(np.frombuffer(file_bytes, np.uint8), cv2.IMREAD_COLOR)
+    if cv_image is None:
+        return None
+    return CROPPER.process_image_array(cv_image, base_name, None, True, PREVIEW_IMAGE_KEYS)
 
-async def _process_with_cropper(file_bytes: bytes) -> Tuple[dict, str]:
-    # Save to a temporary path for AdvancedTableCropper
 
-    original_name = getattr(_process_with_cropper, "_last_name", "uploaded.png")
+async def _process_with_cropper(file_bytes: bytes, original_name: str) -> Tuple[dict, str]:
+    base_name, _ = os.path.splitext(os.path.basename(original_name))
 
-    with tempfile.TemporaryDirectory() as work_dir:
-        input_path = os.path.join(work_dir, original_name)
-        with open(input_path, "wb") as f:
-            f.write(file_bytes)
+    # Decoding and the OpenCV pipeline both release the GIL, so running them in a worker
+    # thread keeps the event loop responsive
+    async with _cropper_semaphore:
+        result = await asyncio.to_thread(_decode_and_crop, file_bytes, base_name)
+    if result is None:
+        raise HTTPException(status_code=400, detail="Could not decode uploaded image")
 
-        cropper = AdvancedTableCropper()
-        result = cropper.process_image(input_path, output_dir=None, return_images=True)
+    return result, base_name
 
-        base_name, _ = os.path.splitext(os.path.basename(original_name))
-        return result, base_name
 
+def _preview_crop(result: dict) -> np.ndarray:
+    out_img: Image.Image = result.get("perspective_corrected")
+    if out_img is None:
+        raise HTTPException(status_code=500, detail="Processing failed to produce an output image")
 
-def upload_to_tmpfiles(image_bytes: bytes, filename: str, content_type: str = "image/png") -> str:
+    # Additional crop: remove ~27% from left and ~12% from bottom
+    rgb = np.asarray(out_img)
+    height, width = rgb.shape[:2]
+    left_trim = int(0.27 * width)
+    bottom_trim = int(0.12 * height)
+    new_right = max(left_trim + 1, width)
+    new_bottom = max(1, height - bottom_trim)
+    # Slice first so only the trimmed region is copied by the color conversion
+    return cv2.cvtColor(rgb[0:new_bottom, left_trim:new_right], cv2.COLOR_RGB2BGR)
+
+
+async def _split_and_upload(arr: np.ndarray, name_base: str) -> dict:
+    mid = arr.shape[0] // 2
+
+    # Array slices are views, so neither half copies pixel data before encoding.
+    # cv2.imencode releases the GIL, so the two encodes run in parallel off the event loop.
+    top_bytes, bottom_bytes = await asyncio.gather(
+        asyncio.to_thread(_bgr_array_to_png_bytes, arr[:mid]),
+        asyncio.to_thread(_bgr_array_to_png_bytes, arr[mid:]),
+    )
+
+    top_name = f"{name_base}_top_half.png"
+    bottom_name = f"{name_base}_bottom_half.png"
+
+    # Upload both halves concurrently
+    top_url, bottom_url = await asyncio.gather(
+        upload_to_tmpfiles(app.state.http, top_bytes, top_name),
+        upload_to_tmpfiles(app.state.http, bottom_bytes, bottom_name),
+    )
+
+    return {
+        "top_half": {"filename": top_name, "url": top_url},
+        "bottom_half": {"filename": bottom_name, "url": bottom_url},
+    }
+
+
+async def upload_to_tmpfiles(
+    client: httpx.AsyncClient,
+    image_bytes: bytes,
+    filename: str,
+    content_type: str = "image/png",
+) -> str:
     """Upload image to tmpfiles.org and return the public URL"""
     try:
         files = {"file": (filename, image_bytes, content_type)}
-        response = requests.post("https://tmpfiles.org/api/v1/upload", files=files)
+        response = await client.post(TMPFILES_UPLOAD_URL, files=files)
         if response.status_code == 200:
             data = response.json()
             if data.get("status") == "success":
@@ -90,46 +256,82 @@ def upload_to_tmpfiles(image_bytes: bytes, filename: str, content_type: str = "i
         raise Exception(f"Failed to upload to tmpfiles.org: {str(e)}")
 
 
+async def _do_crop_and_upload(image: UploadFile, output_format: str = "png") -> dict:
+    _validate_image_content_type(image)
+
+    file_bytes = await image.read()
+    if not file_bytes:
+        raise HTTPException(status_code=400, detail="Empty file uploaded")
+
+    name_base = os.path.splitext(os.path.basename(image.filename or "uploaded"))[0]
+    cache_key = (_content_hash(file_bytes), "preview", name_base, output_format)
+    cached = _result_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    # Drop each large buffer once its successor exists so only one is alive at a time
+    result, base_name = await _process_with_cropper(file_bytes, image.filename or "uploaded.png")
+    del file_bytes
+    cropped = _preview_crop(result)
+    del result
+
+    extension, content_type = _PREVIEW_FORMATS[output_format]
+    encode = _bgr_array_to_jpeg_bytes if output_format == "jpeg" else _bgr_array_to_png_bytes
+    # cv2.imencode releases the GIL, so encode off the event loop
+    encoded = await asyncio.to_thread(encode, cropped)
+    del cropped
+    filename = f"{name_base}_preview.{extension}"
+    url = await upload_to_tmpfiles(app.state.http, encoded, filename, content_type)
+    payload = {"status": "success", "filename": filename, "url": url}
+    _result_cache[cache_key] = payload
+    return payload
+
+
 @app.post("/api/crop-preview")
-async def crop_and_perspective_correction(image: UploadFile = File(...)):
+async def crop_and_perspective_correction(
+    image: UploadFile = File(...),
+    output_format: str = Form("png"),
+):
     """
     API 1: Accept an image, detect corners, apply perspective correction and cropping,
     and upload the corrected image to tmpfiles.org, returning a public URL as JSON.
+    Pass output_format=jpeg for a smaller, faster-to-encode JPEG instead of the default PNG.
     """
     try:
-        _validate_image_content_type(image)
-        # Store filename for naming consistency
-        setattr(_process_with_cropper, "_last_name", image.filename or "uploaded.png")
+        return await _do_crop_and_upload(image, _validate_output_format(output_format))
 
-        file_bytes = await image.read()
-        if not file_bytes:
-            raise HTTPException(status_code=400, detail="Empty file uploaded")
+    except HTTPException:
+        raise
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=f"Processing failed: {str(exc)}")
 
-        result, base_name = await _process_with_cropper(file_bytes)
 
-        # Prefer perspective-corrected; fallback to cropped_table
-        out_img: Image.Image = result.get("perspective_corrected") or result.get("cropped_table") or result.get("original")
-        if out_img is None:
-            raise HTTPException(status_code=500, detail="Processing failed to produce an output image")
+@app.post("/api/crop-preview-batch")
+async def crop_preview_batch(
+    images: list[UploadFile] = File(...),
+    output_format: str = Form("png"),
+):
+    """
+    API 1 (batch): Run the crop-preview pipeline on several images at once. Each image gets its
+    own entry in "results", in upload order, either the usual crop-preview payload or an error.
+    """
+    fmt = _validate_output_format(output_format)
 
-        # Additional crop: remove ~27% from left and ~12% from bottom
-        width, height = out_img.size
-        left_trim = int(0.27 * width)
-        bottom_trim = int(0.12 * height)
-        new_right = max(left_trim + 1, width)
-        new_bottom = max(1, height - bottom_trim)
-        out_img = out_img.crop((left_trim, 0, new_right, new_bottom))
+    async def one(upload: UploadFile) -> dict:
+        async with _batch_semaphore:
+            return await _do_crop_and_upload(upload, fmt)
 
-        png_bytes = _pil_to_png_bytes(out_img)
-        name_base = os.path.splitext(os.path.basename(image.filename or "uploaded"))[0]
-        filename = f"{name_base}_preview.png"
-        url = upload_to_tmpfiles(png_bytes, filename)
-        return JSONResponse({"status": "success", "filename": filename, "url": url})
+    outcomes = await asyncio.gather(*(one(upload) for upload in images), return_exceptions=True)
 
-    except HTTPException:
-        raise
-    except Exception as exc:
-        raise HTTPException(status_code=500, detail=f"Processing failed: {str(exc)}")
+    results = []
+    for upload, outcome in zip(images, outcomes):
+        if isinstance(outcome, HTTPException):
+            results.append({"status": "error", "filename": upload.filename, "error": outcome.detail})
+        elif isinstance(outcome, Exception):
+            results.append({"status": "error", "filename": upload.filename, "error": f"Processing failed: {str(outcome)}"})
+        else:
+            results.append(outcome)
+    return {"status": "success", "results": results}
 
 
 @app.post("/api/split-halves")
@@ -160,10 +362,7 @@ async def split_image_halves(
                 if "tmpfiles.org" in url and "/dl/" not in url:
                     url = url.replace("tmpfiles.org/", "tmpfiles.org/dl/")
 
-                resp = requests.get(url, timeout=30)
-                if resp.status_code != 200:
-                    raise HTTPException(status_code=400, detail=f"Failed to download image: HTTP {resp.status_code}")
-                file_bytes = resp.content
+                file_bytes = await _download_image(url)
                 # Derive a name from the URL
                 original_name = os.path.basename(url.split("?")[0] or "downloaded.png")
                 if not original_name:
@@ -175,31 +374,27 @@ async def split_image_halves(
         else:
             raise HTTPException(status_code=400, detail="Provide either 'image' file or 'image_url' form field")
 
-        pil_img = Image.open(io.BytesIO(file_bytes))
-        pil_img = pil_img.convert("RGB")
-        width, height = pil_img.size
-        mid = height // 2
-
-        top_half = pil_img.crop((0, 0, width, mid))
-        bottom_half = pil_img.crop((0, mid, width, height))
-
-        top_bytes = _pil_to_png_bytes(top_half)
-        bottom_bytes = _pil_to_png_bytes(bottom_half)
-
         # File naming based on original name
         # original_name already set above depending on source
         name_base, _ = os.path.splitext(os.path.basename(original_name))
-        top_name = f"{name_base}_top_half.png"
-        bottom_name = f"{name_base}_bottom_half.png"
 
-        top_url = upload_to_tmpfiles(top_bytes, top_name)
-        bottom_url = upload_to_tmpfiles(bottom_bytes, bottom_name)
+        cache_key = (_content_hash(file_bytes), "halves", name_base)
+        cached = _result_cache.get(cache_key)
+        if cached is not None:
+            return cached
 
-        return JSONResponse({
-            "status": "success",
-            "top_half": {"filename": top_name, "url": top_url},
-            "bottom_half": {"filename": bottom_name, "url": bottom_url}
-        })
+        # Decode straight into a BGR array; no PIL object or mode conversion. EXIF orientation is
+        # ignored, as PIL's Image.open did, so halves are cut from the image as stored.
+        arr = cv2.imdecode(
+            np.frombuffer(file_bytes, np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION
+        )
+        del file_bytes
+        if arr is None:
+            raise HTTPException(status_code=400, detail="Could not decode image")
+
+        payload = {"status": "success", **await _split_and_upload(arr, name_base)}
+        _result_cache[cache_key] = payload
+        return payload
 
     except HTTPException:
         raise
@@ -207,6 +402,42 @@ async def split_image_halves(
         raise HTTPException(status_code=500, detail=f"Split failed: {str(exc)}")
 
 
+@app.post("/api/crop-split")
+async def crop_and_split(image: UploadFile = File(...)):
+    """
+    API 4: Run the crop-preview pipeline and split the result into two horizontal halves in one
+    call, uploading both halves to tmpfiles.org. Equivalent to /api/crop-preview followed by
+    /api/split-halves on its URL, without the intermediate upload, download and PNG round-trip.
+    """
+    try:
+        _validate_image_content_type(image)
+
+        file_bytes = await image.read()
+        if not file_bytes:
+            raise HTTPException(status_code=400, detail="Empty file uploaded")
+
+        name_base = os.path.splitext(os.path.basename(image.filename or "uploaded"))[0]
+        cache_key = (_content_hash(file_bytes), "crop-split", name_base)
+        cached = _result_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        result, base_name = await _process_with_cropper(file_bytes, image.filename or "uploaded.png")
+        del file_bytes
+        cropped = _preview_crop(result)
+        del result
+
+        # Name the halves as split-halves would name them from the crop-preview file
+        payload = {"status": "success", **await _split_and_upload(cropped, f"{name_base}_preview")}
+        _result_cache[cache_key] = payload
+        return payload
+
+    except HTTPException:
+        raise
+    except Exception as exc:
+        raise HTTPException(status_code=500, detail=f"Crop and split failed: {str(exc)}")
+
+
 @app.post("/api/upload-to-tmpfiles")
 async def upload_image_to_tmpfiles(
     image: UploadFile | None = File(None),
@@ -235,10 +466,7 @@ async def upload_image_to_tmpfiles(
                 if "tmpfiles.org" in url and "/dl/" not in url:
                     url = url.replace("tmpfiles.org/", "tmpfiles.org/dl/")
 
-                resp = requests.get(url, timeout=30)
-                if resp.status_code != 200:
-                    raise HTTPException(status_code=400, detail=f"Failed to download image: HTTP {resp.status_code}")
-                file_bytes = resp.content
+                file_bytes = await _download_image(url)
                 # Derive a name from the URL
                 original_name = os.path.basename(url.split("?")[0] or "downloaded.png")
                 if not original_name:
@@ -274,13 +502,13 @@ async def upload_image_to_tmpfiles(
             filename = "uploaded.png"
 
         # Upload raw image bytes directly to tmpfiles (no processing)
-        url = upload_to_tmpfiles(file_bytes, filename, content_type)
+        url = await upload_to_tmpfiles(app.state.http, file_bytes, filename, content_type)
 
-        return JSONResponse({
+        return {
             "status": "success",
             "filename": filename,
             "url": url
-        })
+        }
 
     except HTTPException:
         raise
@@ -289,4 +517,11 @@ async def upload_image_to_tmpfiles(
 
 
 # For local running: `uvicorn fastapi_app:app --host 127.0.0.1 --port 8000 --reload`
+# For deployment: `uvicorn fastapi_app:app --loop uvloop --http httptools --workers N`
+
+if __name__ == "__main__":
+    import uvicorn
 
+    # uvicorn's "auto" loop/http settings pick uvloop and httptools when installed (uvicorn[standard]
+    # on non-Windows) and fall back to asyncio and h11 elsewhere
+    uvicorn.run("fastapi_app:app", host="127.0.0.1", port=8000)
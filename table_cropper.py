@@ -9,6 +9,8 @@ class AdvancedTableCropper:
     def __init__(self):
         self.total_cols = 32
         self.total_rows = 17
+        # Longest edge used for corner detection; larger images are downscaled first
+        self.max_detection_edge = 2048
 
     def detect_table_corners(self, image):
         """
@@ -72,6 +74,21 @@ class AdvancedTableCropper:
             (margin, h - margin)  # bottom-left
         ]
     
+    def detect_table_corners_scaled(self, image):
+        """
+        Detect table corners on a copy downscaled to max_detection_edge and map them back
+        to full-resolution coordinates. Detection cost grows with pixel count, while the
+        perspective warp still samples the original image.
+        """
+        h, w = image.shape[:2]
+        scale = min(1.0, self.max_detection_edge / max(h, w))
+        if scale >= 1.0:
+            return self.detect_table_corners(image)
+        
+        small = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        corners = self.detect_table_corners(small)
+        return [(x / scale, y / scale) for x, y in corners]
+    
     def sort_corners(self, corners):
         """
         Sort corners in order: top-left, top-right, bottom-right, bottom-left
@@ -203,7 +220,7 @@ class AdvancedTableCropper:
         
         return part1, part2
     
-    def process_image(self, input_path, output_dir=None, return_images=False):
+    def process_image(self, input_path, output_dir=None, return_images=False, include_keys=None):
         """
         Main processing function with perspective correction.
 
@@ -213,6 +230,8 @@ class AdvancedTableCropper:
                 a default ./output directory is used. If return_images is True, nothing is saved
                 unless an explicit output_dir is provided.
             return_images (bool): when True, return PIL Images in-memory instead of (or in addition to) saving.
+            include_keys (iterable|None): with return_images, only these image keys are converted and
+                returned (metadata is always included). None returns every image.
 
         Returns:
             - if return_images is True: dict with PIL Images {cropped_table, part1, part2, metadata}
@@ -225,7 +244,32 @@ class AdvancedTableCropper:
             cv_image = cv2.imread(input_path)
             if cv_image is None:
                 raise ValueError(f"Could not load image: {input_path}")
-            
+        except Exception as e:
+            print(f"\n❌ Error processing image: {str(e)}")
+            import traceback
+            traceback.print_exc()
+            return False
+        
+        # Get base filename
+        input_filename = os.path.splitext(os.path.basename(input_path))[0]
+        return self.process_image_array(cv_image, input_filename, output_dir, return_images, include_keys)
+    
+    def process_image_array(self, cv_image, input_filename="image", output_dir=None, return_images=False,
+                            include_keys=None):
+        """
+        Same pipeline as process_image, for an image already decoded in memory.
+
+        Args:
+            cv_image (numpy.ndarray): source image in BGR format
+            input_filename (str): base name used for saved output files
+            output_dir (str|None): see process_image
+            return_images (bool): see process_image
+            include_keys (iterable|None): see process_image
+
+        Returns:
+            Same as process_image.
+        """
+        try:
             print(f"Original image dimensions: {cv_image.shape[1]} x {cv_image.shape[0]}")
             
             # Set up output directory only if we intend to save
@@ -236,20 +280,22 @@ class AdvancedTableCropper:
                     output_dir = os.path.join(script_dir, "output")
                 os.makedirs(output_dir, exist_ok=True)
             
-            # Get base filename
-            input_filename = os.path.splitext(os.path.basename(input_path))[0]
-            
             # Step 1: Detect table corners
             print("Detecting table corners...")
-            corners = self.detect_table_corners(cv_image)
+            corners = self.detect_table_corners_scaled(cv_image)
             print(f"Detected corners: {corners}")
             
-            # Corner visualization (always build in-memory; save if enabled)
-            corner_vis = cv_image.copy()
-            for i, corner in enumerate(corners):
-                cv2.circle(corner_vis, (int(corner[0]), int(corner[1])), 10, (0, 0, 255), -1)
-                cv2.putText(corner_vis, str(i+1), (int(corner[0])+15, int(corner[1])+15), 
-                           cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
+            # Only these images are converted for the caller; None means all of them
+            wanted = None if include_keys is None else set(include_keys)
+            
+            # Corner visualization (a full-size copy, so only built when saved or requested)
+            corner_vis = None
+            if should_save or (return_images and (wanted is None or "corners_vis" in wanted)):
+                corner_vis = cv_image.copy()
+                for i, corner in enumerate(corners):
+                    cv2.circle(corner_vis, (int(corner[0]), int(corner[1])), 10, (0, 0, 255), -1)
+                    cv2.putText(corner_vis, str(i+1), (int(corner[0])+15, int(corner[1])+15), 
+                               cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
             if should_save:
                 corner_vis_path = os.path.join(output_dir, f"{input_filename}_corners.png")
                 cv2.imwrite(corner_vis_path, corner_vis)
@@ -343,16 +389,21 @@ class AdvancedTableCropper:
                 def to_pil(bgr_img):
                     rgb = cv2.cvtColor(bgr_img, cv2.COLOR_BGR2RGB)
                     return Image.fromarray(rgb)
-                return {
-                    "original": to_pil(cv_image),
-                    "corners_vis": to_pil(corner_vis),
-                    "perspective_corrected": to_pil(corrected_image),
-                    "cropped_table": to_pil(cropped_image),
-                    "left_cropped": to_pil(left_cropped_image),
-                    "part1": to_pil(part1),
-                    "part2": to_pil(part2),
-                    "metadata": metadata,
+                images = {
+                    "original": cv_image,
+                    "corners_vis": corner_vis,
+                    "perspective_corrected": corrected_image,
+                    "cropped_table": cropped_image,
+                    "left_cropped": left_cropped_image,
+                    "part1": part1,
+                    "part2": part2,
+                }
+                output = {
+                    key: to_pil(img) for key, img in images.items()
+                    if wanted is None or key in wanted
                 }
+                output["metadata"] = metadata
+                return output
             else:
                 if should_save:
                     print("\n" + "="*60)